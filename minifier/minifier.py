@@ -1,56 +1,43 @@
 import re
+import sys
 from dataclasses import dataclass
 import subprocess
+from collections import Counter
+from functools import lru_cache
+from itertools import chain, compress, count
 
 #################
 # Name mangling #
 #################
 
-# KEY: TOKEN
-# VALUE: MANGLED NAME
-names = dict()
-TYPES = ['int', 'void', 'uint16_t', 'uint32_t', 'uint64_t',
-         'bool', 'auto', 'int32_t', 'string', 'vector', 'istringstream']
-KEYWORDS = TYPES + ['return', 'printf', 'struct', 'main', 'std', 'push_back', 'back',
-                    'pop_back', 'reserve', 'cout', '__builtin_bswap64', '__builtin_ctzll', 'const', 'assert',
-                    'endl', 'for', 'while', 'swap', 'if', 'else', 'char', 'abs', 'getline',
-                    'break', 'length', 'switch', 'case', 'cin', 'empty', 'continue', 'size',
-                    'default', 'using', 'namespace', '__builtin_popcountll', 'stoi', 'chrono', 'second',
-                    'high_resolution_clock', 'duration_cast', 'milliseconds', 'now', 'max', 'pair', 'stable_sort', 'greater', 'min']
-global counter, resets
-counter = 65  # ASCII A
-resets = 0  # Number of times the counter has exceeded reset back to A
+TYPES = frozenset({'int', 'void', 'uint16_t', 'uint32_t', 'uint64_t',
+                   'bool', 'auto', 'int32_t', 'string', 'vector', 'istringstream'})
+KEYWORDS = TYPES | frozenset({'return', 'printf', 'struct', 'main', 'std', 'push_back', 'back',
+                              'pop_back', 'reserve', 'cout', '__builtin_bswap64', '__builtin_ctzll', 'const', 'assert',
+                              'endl', 'for', 'while', 'swap', 'if', 'else', 'char', 'abs', 'getline',
+                              'break', 'length', 'switch', 'case', 'cin', 'empty', 'continue', 'size',
+                              'default', 'using', 'namespace', '__builtin_popcountll', 'stoi', 'chrono', 'second',
+                              'high_resolution_clock', 'duration_cast', 'milliseconds', 'now', 'max', 'pair', 'stable_sort', 'greater', 'min'})
+# Splits on every non-word char, keeping the separators as tokens
+_TOKEN_RE = re.compile(r'([^\w])')
 
 
-def generate_name(token: str) -> str:
-    """Generates a new name for a token. If the token has already been before, return that name to keep coherency."""
-    global counter, resets
-
-    # Already mangled
-    if token in names:
-        return names[token]
-
-    # Generate a new name
-    names[token] = chr(counter) * (resets + 1)
-
-    # Jump to lowercase letters
-    if counter == 90:  # previous char was ASCII Z
-        counter = 96   # ASCII before 'a', because we increment after this to get to 'a'
-
-    # Increment counter so that the next name is different
-    counter += 1
-    if counter > 122:  # ASCII z
-        counter = 65
-        resets += 1
-
-    return names[token]
+def name_pool():
+    """Yields mangled names in order: A-Z, a-z, then the same letters doubled (AA-zz), tripled, etc."""
+    letters = [chr(c) for c in chain(range(ord('A'), ord('Z') + 1), range(ord('a'), ord('z') + 1))]
+    for length in count(1):
+        for letter in letters:
+            yield letter * length
 
 
 def fetch_tokens(content: str) -> list:
     """Fetches all the tokens from the source code. A token is a word, number, whitespace, symbol, etc."""
-    return [t for t in re.split('([^\w])', content) if t]
+    # Interned so that repeated tokens share one object, making the many dict/set lookups cheaper
+    return [sys.intern(t) for t in _TOKEN_RE.split(content) if t]
 
 
+# Memoized, as the same few distinct tokens get classified over and over
+@lru_cache(maxsize=None)
 def is_name(token: str) -> bool:
     """A name of /something/. Either a variable, function, class, etc."""
     return token and (token[0].isalpha() or token.startswith('_'))
@@ -61,11 +48,13 @@ def is_keyword(token: str) -> bool:
     return token in KEYWORDS
 
 
+@lru_cache(maxsize=None)
 def renamable(token: str) -> bool:
     """Returns whether the token is renamable, i.e names that aren't types/keywords."""
     return not is_keyword(token) and is_name(token)
 
 
+@lru_cache(maxsize=None)
 def attach_eligible(token: str) -> bool:
     """Returns whether a token is eligible to be attached together to save whitespace."""
     # Some c++ numbers have suffixes like 1ULL which is 1 as an unsigned long long.
@@ -78,71 +67,132 @@ def attachable_tokens(first: str, second: str) -> bool:
     return attach_eligible(first) or attach_eligible(second)
 
 
-def group_tokens(token_list: list, start: list, end: list, include_end: bool = True, include_space: bool = True) -> list:
-    """Finds ``start`` tokens and concatenates everything from ``start``-``end``."""
+def tokens_match(token_list: list, idx: int, pattern: list) -> bool:
+    """Returns whether ``token_list`` starting at ``idx`` matches ``pattern``."""
+    if idx + len(pattern) > len(token_list):
+        return False
+
+    # Compare short patterns directly rather than allocating a slice to compare against
+    if len(pattern) == 1:
+        return token_list[idx] == pattern[0]
+    if len(pattern) == 2:
+        return token_list[idx] == pattern[0] and token_list[idx + 1] == pattern[1]
+    return token_list[idx] == pattern[0] and pattern == token_list[idx:idx + len(pattern)]
+
+
+# Token groups such as comments, strings, etc. as (start, end, include_end, include_space, nests, nestable).
+# When several groups could begin at the same token, the earliest one in this list wins.
+# Groups that nest skip over any complete nestable group (string or comment) inside of them while
+# looking for their end, so e.g. an #endif in a comment can't end a deletion region. Chars aren't
+# nestable, as a stray ' (e.g. "don't" or 1'000) would pair up with one far past the real end.
+GROUPS = [
+    (['"'], ['"'], True, True, False, True),                                      # Strings
+    (['/', '*'], ['*', '/'], True, True, False, True),                            # Block comments
+    (['[', '['], [']', ']'], True, True, True, False),                            # Attributes
+    (['#', 'include'], ['\n'], True, False, True, False),                         # Includes
+    (['#', 'ifndef', ' ', 'MINIFIED'], ['#', 'endif'], True, True, True, False),  # Deletion regions
+    (['/', '/'], ['\n'], False, True, False, True),                               # Line comments
+    (["'"], ["'"], True, True, False, False),                                     # Chars
+]
+
+
+def group(tokens: list, content: str) -> list:
+    """Groups all relevant tokens together, such as comments, strings and deletion regions."""
+    # Only look for groups whose start actually appears somewhere in the source
+    groups = [grp for grp in GROUPS if "".join(grp[0]) in content]
+    if not groups:
+        return tokens
+    nestable = [grp for grp in groups if grp[5]]
+
     output = []
 
-    # This is the start index where we look for first index such that [idx + len(start)] <=> start
+    # The group we're currently inside of (if any) and the index of its first token
+    active = None
     start_idx = 0
 
-    while start_idx < len(token_list):
-
-        # end must be after the start, so set it to start + 1
-        end_idx = start_idx + 1
+    # A nestable group inside of the active one (if any) and the index of its first token
+    inner = None
+    inner_idx = 0
+
+    # A single sweep over the tokens, looking for the start of a group when outside of one
+    # and for the end of the active group when inside of one.
+    idx = 0
+    while idx < len(tokens) or active is not None:
+
+        if idx >= len(tokens):
+            # Never found the end of the inner group, so its first token was just a token
+            # and we carry on looking for the end of the active group after it. Its end can't
+            # appear anywhere after this either, so don't look for that group again.
+            if inner is not None:
+                nestable.remove(inner)
+                idx = inner_idx + 1
+                inner = None
+                continue
 
-        # Verify that there is still space in the token list in the first condition.
-        # In the second condition, check that start that was passed in ==
-        # token_list starting at start_idx till start_idx + len(start).
-        # Recollect that start_idx is just an idx, and start_idx + len(start) is a
-        # subsequence of token_list of size len(start)
-        if (start_idx + len(start) <= len(token_list)) and (start == token_list[start_idx:start_idx + len(start)]):
+            # Never found the end of the group, so just add its first token and carry on after it,
+            # exactly as if nothing had been found there.
+            output.append(tokens[start_idx])
+            idx = start_idx + 1
+            active = None
+            continue
 
-            # Search all possible end idxs from the end of the start to the end of the string.
-            # Give padding for the size of the end token.
-            for possible_end_idx in range(end_idx + len(start) - 1, len(token_list) - len(end) + 1):
+        token = tokens[idx]
 
-                # Similar to the first condition, check if from end idx to len(end) == passed in end.
-                if end == token_list[possible_end_idx: possible_end_idx + len(end)]:
-                    # Just include the whole end if that param is true.
-                    end_idx = possible_end_idx + \
-                        len(end) if include_end else possible_end_idx
+        if active is None:
+            for grp in groups:
+                start = grp[0]
+                if tokens_match(tokens, idx, start):
+                    active = grp
+                    start_idx = idx
+                    idx += len(start)
                     break
+            else:
+                output.append(token)
+                idx += 1
+            continue
 
-        # Self-explanatory, join everything from start to end. If we never found anything this is
-        # start:start+1 because we set end_idx to start + 1 at the beginning.
-        # This adds just the token if we found nothing.
-        grouped_tokens = "".join(token_list[start_idx:end_idx])
-        if not include_space and end_idx != start_idx + 1:
-            grouped_tokens = grouped_tokens.replace(" ", "")
+        # Skip to the end of the inner group, it can't contain the end of the active one
+        if inner is not None:
+            end = inner[1]
+            if tokens_match(tokens, idx, end):
+                idx = idx + len(end) if inner[2] else idx
+                inner = None
+            else:
+                idx += 1
+            continue
 
-        output.append(grouped_tokens)
+        _, end, include_end, include_space, nests, _ = active
+        if tokens_match(tokens, idx, end):
+            end_idx = idx + len(end) if include_end else idx
+            grouped_tokens = "".join(tokens[start_idx:end_idx])
+            if not include_space:
+                grouped_tokens = grouped_tokens.replace(" ", "")
+            output.append(grouped_tokens)
+            active = None
+            idx = end_idx
+            continue
 
-        # We searched everything from start to end, so no need to research. set start to old end.
-        start_idx = end_idx
+        if nests:
+            for grp in nestable:
+                start = grp[0]
+                if tokens_match(tokens, idx, start):
+                    inner = grp
+                    inner_idx = idx
+                    idx += len(start)
+                    break
+            else:
+                idx += 1
+        else:
+            idx += 1
 
     return output
 
 
-def group(tokens: list) -> list:
-    """Groups all relevant tokens together, such as comments, strings and deletion regions."""
-    # Create token groups such as comments, strings, etc.
-    tokens = group_tokens(tokens, ['"'], ['"'])              # Strings
-    tokens = group_tokens(tokens, ['/', '*'], ['*', '/'])    # Block comments
-    tokens = group_tokens(tokens, ['[', '['], [']', ']'])    # Attributes
-    tokens = group_tokens(tokens, ['#', 'include'], ['\n'], include_space=False)  # Includes
-
-    # Deletion regions
-    tokens = group_tokens(tokens, ['#', 'ifndef', ' ', 'MINIFIED'], ['#', 'endif'])
-
-    tokens = group_tokens(tokens, ['/', '/'], ['\n'], include_end=False)  # Line comments
-    tokens = group_tokens(tokens, ["'"], ["'"])               # Chars
-
-    return tokens
-
-
 def strip(tokens: list) -> list:
     """Strips out all tokens that shouldn't be present in final code."""
-    new_tokens = []
+    # Can never be longer than the input, so allocate that up front and trim at the end
+    new_tokens = [None] * len(tokens)
+    j = 0
     for token in tokens:
         # line/block comments, deletion regions and attributes
         if token.startswith('//') or token.startswith('/*') or token.startswith('[[') or token.startswith('#ifndef'):
@@ -152,29 +202,45 @@ def strip(tokens: list) -> list:
         if token == '\n' or token.isspace() or token == 'const':
             continue
 
-        new_tokens.append(token)
+        new_tokens[j] = token
+        j += 1
 
+    del new_tokens[j:]
     return new_tokens
 
 
-@dataclass
+def classify(tokens: list) -> tuple:
+    """Classifies every token once, giving flags for whether each is a name, attach eligible and renamable."""
+    name_flags = bytearray(len(tokens))
+    attach_flags = bytearray(len(tokens))
+    rename_flags = bytearray(len(tokens))
+
+    for i, token in enumerate(tokens):
+        name_flags[i] = is_name(token)
+        attach_flags[i] = attach_eligible(token)
+        rename_flags[i] = renamable(token)
+
+    return name_flags, attach_flags, rename_flags
+
+
+@dataclass(slots=True)
 class Struct:
     name: str
-    fields: list
-    functions: list
-    top_lvl_used: list
+    fields: dict
+    functions: dict
+    top_lvl_used: dict
 
     def __init__(self, name: str):
         self.fields = dict()
         self.functions = dict()
-        self.top_lvl_used = []
+        self.top_lvl_used = dict()  # Used as an ordered set
         self.name = name
 
 
-@dataclass
+@dataclass(slots=True)
 class Function:
-    args: dict()
-    variables: dict()
+    args: dict
+    variables: dict
 
     def __init__(self):
         self.args = dict()
@@ -188,7 +254,7 @@ def is_type(info: dict, token: str) -> bool:
 
 def preceded_by_type(info: dict, prev: str, prev_prev: str) -> bool:
     """Check if token is preceeded by type."""
-    return is_type(info, prev) or (prev in ['>', '&'] and is_type(info, prev_prev))
+    return is_type(info, prev) or ((prev == '>' or prev == '&') and is_type(info, prev_prev))
 
 
 def scope_change(token: str, opener: str, closer: str) -> int:
@@ -196,7 +262,11 @@ def scope_change(token: str, opener: str, closer: str) -> int:
     return (token == opener) - (token == closer)
 
 
-def get_stats(tokens: list) -> dict:
+# Tokens that can follow a function argument
+_COMMA_OR_RP = (',', ')')
+
+
+def get_stats(tokens: list, name_flags: bytearray) -> dict:
     """Analyses struct and function structure, recording frequency stats as it goes."""
     entering_function = False
     struct = None
@@ -208,10 +278,23 @@ def get_stats(tokens: list) -> dict:
     prev = None
     prev_prev = None
 
+    # Local aliases for the helpers used on every token
+    _preceded_by_type = preceded_by_type
+    _scope_change = scope_change
+    _TYPES = TYPES
+
+    # Sentinel at the end so the token following the last one can be read without a bounds check
+    padded = tokens + [None]
+
     for i, token in enumerate(tokens):
+        following = padded[i + 1]
+
+        # A name preceded by a type, i.e. the declaration of a function, variable or field
+        declaration = name_flags[i] and _preceded_by_type(structinfo, prev, prev_prev)
+
         # Handle exiting function
         if not entering_function and function is not None:
-            function_scope += scope_change(token, '{', '}')
+            function_scope += _scope_change(token, '{', '}')
             if function_scope == 0:
                 function = None
 
@@ -221,14 +304,13 @@ def get_stats(tokens: list) -> dict:
                 parenth_depth += 1
             elif token == ')':
                 parenth_depth -= 1
-            elif parenth_depth > 0 and tokens[i + 1] in [',', ')'] and token not in TYPES:
+            elif parenth_depth > 0 and following in _COMMA_OR_RP and token not in _TYPES:
                 structinfo[struct].functions[function].args[token] = 1
             if parenth_depth == 0:
                 entering_function = False
 
         # Found a function
-        following = tokens[i + 1] if i + 1 < len(tokens) else None
-        if is_name(token) and preceded_by_type(structinfo, prev, prev_prev) and following == '(':
+        if declaration and following == '(':
             entering_function = True
             function = token
             structinfo[struct].functions[token] = Function()
@@ -243,12 +325,12 @@ def get_stats(tokens: list) -> dict:
                 structinfo[struct].functions[function].variables[token] += 1
 
             # Found declaration of local variable
-            if not entering_function and is_name(token) and preceded_by_type(structinfo, prev, prev_prev):
+            if not entering_function and declaration:
                 structinfo[struct].functions[function].variables[token] = 1
 
         # Exiting struct?
         if struct is not None:
-            struct_scope += scope_change(token, '{', '}')
+            struct_scope += _scope_change(token, '{', '}')
             if struct_scope == 0:
                 struct = None
 
@@ -258,7 +340,7 @@ def get_stats(tokens: list) -> dict:
             structinfo[struct] = Struct(token)
 
         # Found a struct field
-        if struct_scope == 1 and is_name(token) and function is None and preceded_by_type(structinfo, prev, prev_prev):
+        if struct_scope == 1 and declaration and function is None:
             structinfo[struct].fields[token] = 1
 
         if token in structinfo[struct].fields:
@@ -266,7 +348,7 @@ def get_stats(tokens: list) -> dict:
 
         # Record what top level functions are used in each struct
         if token in structinfo[None].functions and token not in structinfo[struct].top_lvl_used and struct is not None:
-            structinfo[struct].top_lvl_used.append(token)
+            structinfo[struct].top_lvl_used[token] = None
 
         prev_prev = prev
         prev = token
@@ -276,16 +358,20 @@ def get_stats(tokens: list) -> dict:
 
 def print_stats(structinfo: dict):
     """Pretty print stats."""
+    import copy
     import pprint
     pp = pprint.PrettyPrinter(indent=4)
     for struct in structinfo:
-        pp.pprint(structinfo[struct])
+        # Show the top level functions used as a list, in the order they were first used
+        info = copy.copy(structinfo[struct])
+        info.top_lvl_used = list(info.top_lvl_used)
+        pp.pprint(info)
         print("")
 
 
-def sort_dict(dictionary: dict) -> dict:
-    """Sorts dictionary in descending order by value."""
-    return {k: v for k, v in sorted(dictionary.items(), key=lambda item: -item[1])}
+def sort_keys_desc(dictionary: dict) -> list:
+    """Returns the keys of the dictionary in descending order by value."""
+    return sorted(dictionary, key=dictionary.__getitem__, reverse=True)
 
 
 def get_ir_renames(structinfo: dict):
@@ -301,7 +387,7 @@ def get_ir_renames(structinfo: dict):
 
         # Choose struct field names
         j = 0
-        sorted_fields = sort_dict(structinfo[struct].fields)
+        sorted_fields = sort_keys_desc(structinfo[struct].fields)
         for field in sorted_fields:
             if field in fields:
                 ir[struct].fields[field] = fields[field]
@@ -319,12 +405,12 @@ def get_ir_renames(structinfo: dict):
             ir[struct].functions[func] = Function()
 
             # Choose function argument names
-            sorted_args = sort_dict(structinfo[struct].functions[func].args)
+            sorted_args = sort_keys_desc(structinfo[struct].functions[func].args)
             for y, arg in enumerate(sorted_args):
                 ir[struct].functions[func].args[arg] = "arg" + str(y)
 
             # Choose local variable names
-            sorted_vars = sort_dict(
+            sorted_vars = sort_keys_desc(
                 structinfo[struct].functions[func].variables)
             for y, var in enumerate(sorted_vars):
                 ir[struct].functions[func].variables[var] = "var" + str(y)
@@ -346,9 +432,10 @@ def get_ir_renames(structinfo: dict):
     return ir, fields, methods
 
 
-def to_ir(tokens: list, ir: dict, fields: dict, methods: dict) -> list:
-    """Transforms tokens into intermediate representation with given renames."""
-    new_tokens = []
+def to_ir(tokens: list, rename_flags: bytearray, ir: dict, fields: dict, methods: dict) -> list:
+    """Transforms tokens into intermediate representation with given renames, keeping ``rename_flags`` up to date."""
+    # Every token maps to exactly one IR token
+    new_tokens = [None] * len(tokens)
     entering_function = False
     struct = None
     function = None
@@ -357,26 +444,37 @@ def to_ir(tokens: list, ir: dict, fields: dict, methods: dict) -> list:
     parenth_depth = 0
     prev = None
 
-    for token in tokens:
+    # Renames for the args and local variables of the function we're in (empty outside of one)
+    args = dict()
+    variables = dict()
+
+    # Local aliases for the helpers used on every token
+    _scope_change = scope_change
+
+    for i, token in enumerate(tokens):
         # Handle exiting function
         if not entering_function and function != None:
-            function_scope += scope_change(token, '{', '}')
+            function_scope += _scope_change(token, '{', '}')
             if function_scope == 0:
                 function = None
+                args = dict()
+                variables = dict()
 
         # Record args
         if entering_function:
-            parenth_depth += scope_change(token, '(', ')')
+            parenth_depth += _scope_change(token, '(', ')')
             if parenth_depth == 0:
                 entering_function = False
 
         if token in methods and function is None:
             function = token
             entering_function = True
+            args = ir[struct].functions[function].args
+            variables = ir[struct].functions[function].variables
 
         # Exiting struct?
         if struct != None:
-            struct_scope += scope_change(token, '{', '}')
+            struct_scope += _scope_change(token, '{', '}')
             if struct_scope == 0:
                 struct = None
 
@@ -385,101 +483,99 @@ def to_ir(tokens: list, ir: dict, fields: dict, methods: dict) -> list:
             struct = token
 
         # Rename if appropriate
-        if function is not None and token in ir[struct].functions[function].args:
-            token = ir[struct].functions[function].args[token]
+        renamed = True
+        if token in args:
+            token = args[token]
         elif token in fields:
             token = fields[token]
         elif token in methods:
             token = methods[token]
-        elif function is not None and token in ir[struct].functions[function].variables:
-            token = ir[struct].functions[function].variables[token]
+        elif token in variables:
+            token = variables[token]
+        else:
+            renamed = False
+
+        # A keyword used as a name (e.g. a field called size) becomes renamable once given an IR name
+        if renamed:
+            rename_flags[i] = renamable(token)
 
         prev = token
-        new_tokens.append(token)
+        new_tokens[i] = token
 
     return new_tokens
 
 
-def get_frequencies(tokens: list) -> dict:
-    """Works out frequency of each token."""
-    freq = dict()
-
-    for token in tokens:
-        if not renamable(token):
-            continue
-
-        freq[token] = (freq[token] + 1) if token in freq else 1
-
-    return sort_dict(freq)
+def get_frequencies(tokens: list, rename_flags: bytearray) -> list:
+    """Works out frequency of each renamable token, returning them from most to least frequent."""
+    freq = Counter(compress(tokens, rename_flags))
+    return [token for token, _ in freq.most_common()]
 
 
 def minify(content: str, verbose: bool):
     """Combines all steps, producing a fully-minified file."""
     tokens = fetch_tokens(content)
-    tokens = group(tokens)
+    tokens = group(tokens, content)
     tokens = strip(tokens)
+    name_flags, attach_flags, rename_flags = classify(tokens)
 
-    structinfo = get_stats(tokens)
+    structinfo = get_stats(tokens, name_flags)
     if verbose:
         print_stats(structinfo)
 
     ir, fields, methods = get_ir_renames(structinfo)
-    tokens = to_ir(tokens, ir, fields, methods)
-
-    # Write IR to file, for easier debugging
-    prev = None
-    ir_tokens = []
-    for token in tokens:
-        if prev and not attachable_tokens(prev, token):
-            ir_tokens.append(' ')
-        prev = token
-        ir_tokens.append(token)
-    with open('plir.cpp', 'w') as f:
-        f.write(''.join(ir_tokens))
-
-    # Make it look nice
-    try:
-        subprocess.run(["clang-format", "--style=file", "-i",
-                       "plir.cpp"], stdout=subprocess.DEVNULL)
-    except:
-        try:
-            subprocess.run(["./clang-format", "--style=file",
-                           "-i", "plir.cpp"], stdout=subprocess.DEVNULL)
-        except:
-            pass
+    tokens = to_ir(tokens, rename_flags, ir, fields, methods)
 
-    # Now the real minifying begins
-    new_tokens = []
-    prev = None
+    # KEY: TOKEN
+    # VALUE: MANGLED NAME
+    # Don't rename keywords
+    names = {kw: kw for kw in KEYWORDS}
 
     # Replace true and false with 1 and 0
     names['true'] = '1'
     names['false'] = '0'
 
-    # Don't rename keywords
-    for kw in KEYWORDS:
-        names[kw] = kw
-
-    # Generate names in order of frequency
-    freq = get_frequencies(tokens)
+    # Generate names in order of frequency, leaving any already chosen above alone
+    pool = name_pool()
+    freq = get_frequencies(tokens, rename_flags)
     for token in freq:
-        names[token] = generate_name(token)
+        if token not in names:
+            names[token] = next(pool)
 
-    for token in tokens:
-        # Add a seperator between tokens that can't be attached to each other.
-        # For example: Two names (int main)
-        if prev and not attachable_tokens(prev, token):
-            new_tokens.append(' ')
+    # Write the IR (for easier debugging) and the fully-minified code in the same pass,
+    # streaming tokens straight into the files
+    with open('plir.cpp', 'w', buffering=1 << 20) as ir_file, \
+            open('pytteliten-mini.cpp', 'w', buffering=1 << 20) as mini_file:
 
-        # If the token is a name, but not a keyword, we mangle it.
-        if renamable(token):
-            token = names[token]
+        # Local aliases for the helpers used on every token
+        ir_write = ir_file.write
+        write = mini_file.write
 
-        prev = token
-        new_tokens.append(token)
+        for i, token in enumerate(tokens):
+            # Add a seperator between tokens that can't be attached to each other.
+            # For example: Two names (int main). Renaming only ever swaps one name for another,
+            # so the attach flags hold for both the IR and the fully-minified tokens.
+            if i and not (attach_flags[i - 1] or attach_flags[i]):
+                ir_write(' ')
+                write(' ')
+
+            ir_write(token)
+
+            # If the token is a name, but not a keyword, we mangle it.
+            if rename_flags[i]:
+                token = names[token]
 
-    with open('pytteliten-mini.cpp', 'w') as f:
-        f.write(''.join(new_tokens))
+            write(token)
+
+    # Make it look nice
+    try:
+        subprocess.run(["clang-format", "--style=file", "-i",
+                       "plir.cpp"], stdout=subprocess.DEVNULL)
+    except OSError:
+        try:
+            subprocess.run(["./clang-format", "--style=file",
+                           "-i", "plir.cpp"], stdout=subprocess.DEVNULL)
+        except OSError:
+            pass
 
 
 if __name__ == '__main__':
@@ -531,30 +627,61 @@ if __name__ == '__main__':
     assert not attachable_tokens('1', '2')
     assert not attachable_tokens('return', '0')
 
-    assert group_tokens(["a", "b", "c", "d"], ["a"], ["b"]) == ["ab", "c", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["b"], ["c"]) == ["a", "bc", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["c"], ["d"]) == ["a", "b", "cd"]
-    assert group_tokens(["a", "b", "c", "d"], ["a"], ["d"]) == ["abcd"]
-    assert group_tokens(["a", "b", "c", "d"], ["c"], [
-        "b"]) == ["a", "b", "c", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["b"], [
-        "e"]) == ["a", "b", "c", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["b"], [
-        "b"]) == ["a", "b", "c", "d"]
-    assert group_tokens(["a", "b", "c", "d"], [
-                        "a", "b"], ["c"]) == ["abc", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["a"],
-                        ["b", "c"]) == ["abc", "d"]
-    assert group_tokens(["a", "b", "c", "d"], [
-                        "a", "b", "c"], ["d"]) == ["abcd"]
-    assert group_tokens(["a", "b", "c", "d"], ["a"],
-                        ["c"], True) == ["abc", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["a"], [
-        "c"], False) == ["ab", "c", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["c"], [
-        "e"]) == ["a", "b", "c", "d"]
-    assert group_tokens(["a", "b", "c", "d"], ["e"], [
-        "c"]) == ["a", "b", "c", "d"]
+    assert tokens_match(["a", "b", "c", "d"], 1, ["b"])
+    assert tokens_match(["a", "b", "c", "d"], 1, ["b", "c"])
+    assert tokens_match(["a", "b", "c", "d"], 1, ["b", "c", "d"])
+    assert not tokens_match(["a", "b", "c", "d"], 0, ["b"])
+    assert not tokens_match(["a", "b", "c", "d"], 0, ["a", "c"])
+    assert not tokens_match(["a", "b", "c", "d"], 0, ["a", "b", "d"])
+    assert not tokens_match(["a", "b", "c", "d"], 3, ["d", "e"])
+
+    pool = name_pool()
+    generated = [next(pool) for _ in range(54)]
+    assert generated[:3] == ['A', 'B', 'C']
+    assert generated[25:28] == ['Z', 'a', 'b']
+    assert generated[51:] == ['z', 'AA', 'BB']
+
+    assert sort_keys_desc({'a': 1, 'b': 3, 'c': 2, 'd': 3}) == ['b', 'd', 'c', 'a']
+    assert get_frequencies(['b', 'int', 'a', '+', 'a', 'b', 'c'], [1, 0, 1, 0, 1, 1, 1]) == ['b', 'a', 'c']
+
+    assert classify(['int', 'a', '+', '1']) == (bytearray([1, 1, 0, 0]), bytearray([0, 0, 1, 0]), bytearray([0, 1, 0, 0]))
+
+    assert group(['a', '"', 'b', ' ', 'c', '"', 'd'], 'a"b c"d') == ['a', '"b c"', 'd']
+    assert group(['/', '/', ' ', 'a', '"', '\n', 'b'], '// a"\nb') == ['// a"', '\n', 'b']
+    assert group(['#', 'include', ' ', '<', 'vector', '>', '\n'], '#include <vector>\n') == ['#include<vector>\n']
+    assert group(['#', 'ifndef', ' ', 'MINIFIED', 'a', '#', 'endif', 'b'], '#ifndef MINIFIEDa#endifb') == ['#ifndef MINIFIEDa#endif', 'b']
+    assert group(["'", 'a', '"', 'b', '"'], '\'a"b"') == ["'", 'a', '"b"']
+    assert group(['/', '*', 'a', '"'], '/*a"') == ['/', '*', 'a', '"']
+    assert group(['a', '/', 'b', '*', '/'], 'a/b*/') == ['a', '/', 'b', '*', '/']
+
+    # An #endif inside a string or comment doesn't end a deletion region
+    src = '#ifndef MINIFIED\n/* #endif */\nint a;\n#endif\nint b;'
+    assert group(fetch_tokens(src), src) == ['#ifndef MINIFIED\n/* #endif */\nint a;\n#endif', '\n', 'int', ' ', 'b', ';']
+    src = '#ifndef MINIFIED\nauto s = "#endif";\n#endif\nint b;'
+    assert group(fetch_tokens(src), src) == ['#ifndef MINIFIED\nauto s = "#endif";\n#endif', '\n', 'int', ' ', 'b', ';']
+    src = '#ifndef MINIFIED\n// #endif\n#endif\n'
+    assert group(fetch_tokens(src), src) == ['#ifndef MINIFIED\n// #endif\n#endif', '\n']
+    src = '#ifndef MINIFIED\n"\n#endif\n'
+    assert group(fetch_tokens(src), src) == ['#ifndef MINIFIED\n"\n#endif', '\n']
+    src = '#include <vector> // "x"\n'
+    assert group(fetch_tokens(src), src) == ['#include<vector>//"x"\n']
+
+    # A stray ' inside a deletion region doesn't pair up with one outside of it
+    src = "#ifndef MINIFIED\n#error don't\n#endif\nint y; char c='a';\n#ifndef MINIFIED\nint z;\n#endif\nint w;\n"
+    assert group(fetch_tokens(src), src) == [
+        "#ifndef MINIFIED\n#error don't\n#endif", '\n', 'int', ' ', 'y', ';', ' ', 'char', ' ', 'c', '=', "'a'", ';',
+        '\n', '#ifndef MINIFIED\nint z;\n#endif', '\n', 'int', ' ', 'w', ';', '\n']
+    src = "#ifndef MINIFIED\nint x = 1'000;\n#endif\nchar c = 'a';\n"
+    assert group(fetch_tokens(src), src) == [
+        "#ifndef MINIFIED\nint x = 1'000;\n#endif", '\n', 'char', ' ', 'c', ' ', '=', ' ', "'a'", ';', '\n']
+
+    # Strings, comments and chars don't group inside each other
+    src = "c = '\"'; s = \"'\";"
+    assert group(fetch_tokens(src), src) == ['c', ' ', '=', ' ', "'\"'", ';', ' ', 's', ' ', '=', ' ', '"\'"', ';']
+    src = '/* "a */ b "c" */'
+    assert group(fetch_tokens(src), src) == ['/* "a */', ' ', 'b', ' ', '"c"', ' ', '*', '/']
+
+    assert strip(['int', ' ', 'a', '\n', '// a', '\n', 'const', '=', '1', ';']) == ['int', 'a', '=', '1', ';']
 
     with open('main.cpp', 'r') as f:
         src = f.read()